@@ -1,31 +1,91 @@
+import io
+import asyncio
 import os
 import re
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+import functools
+from contextlib import closing, suppress
+from concurrent.futures import ThreadPoolExecutor
+import imagehash
+from cachetools import TTLCache
 from PIL import Image as PILImage
 from agno.agent import Agent
 from agno.models.google import Gemini
 from agno.media import Image as AgnoImage
+from agno.tools.duckduckgo import DuckDuckGoTools
+from agno.run import RunStatus
+from agno.run.agent import RunEvent
 import streamlit as st
 
 # -------------------------------------------------------------------
 # Environment Setup
 # -------------------------------------------------------------------
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-if not GOOGLE_API_KEY:
-    raise ValueError("⚠️ Please set your Google API Key in GOOGLE_API_KEY")
-os.environ["GOOGLE_API_KEY"] = GOOGLE_API_KEY
 
 # -------------------------------------------------------------------
-# Initialize Medical Agent
-# -------------------------------------------------------------------
-# Switched to gemini-1.5-flash for stability
-# Removed DuckDuckGoTools to prevent 429 Rate Limit errors
-# -------------------------------------------------------------------
-# Initialize Medical Agent
+# Medical Analysis Prompt
 # -------------------------------------------------------------------
+query = """
+You are a highly skilled medical imaging expert with extensive knowledge in radiology and diagnostic imaging. Analyze the medical image and structure your response as follows:
+
+### 1. Image Type & Region
+- Identify imaging modality (X-ray/MRI/CT/Ultrasound/etc.).
+- Specify anatomical region and positioning.
+- Evaluate image quality and technical adequacy.
+
+### 2. Key Findings
+- Highlight primary observations systematically.
+- Identify potential abnormalities with detailed descriptions.
+- Include measurements and densities where relevant.
+
+### 3. Diagnostic Assessment
+- Provide primary diagnosis with confidence level.
+- List differential diagnoses ranked by likelihood.
+- Support each diagnosis with observed evidence.
+- Highlight critical/urgent findings.
+
+### 4. Patient-Friendly Explanation
+- Simplify findings in clear, non-technical language.
+- Avoid medical jargon or provide easy definitions.
+- Include relatable visual analogies.
+
+### 5. Medical Context & Next Steps
+- Suggest standard clinical next steps (e.g., referral, biopsy, follow-up imaging).
+- Provide general treatment protocols for the identified condition based on standard medical guidelines.
+
+Ensure a structured and medically accurate response using clear markdown formatting.
+
+Finally, end your response with a fenced ```json block containing exactly:
+{"primary_diagnosis": "<short primary diagnosis>", "confidence": <number between 0 and 1>}
+"""
+
+# The static instructions above go in the agent's system message, where the
+# provider can cache them; each run only sends this short prompt + the image
+ANALYSIS_PROMPT = "Analyze this medical image."
+
+# Web research runs as a separate, optional step after the report is shown
+RESEARCH_PROMPT = """
+Find recent, reputable medical references (guidelines, review articles, PubMed entries) for: {diagnosis}
+List 3-5 sources as markdown links, each with a one-line note on its relevance.
+"""
+
 # -------------------------------------------------------------------
 # Initialize Medical Agent (with defensive error handling)
 # -------------------------------------------------------------------
+# The diagnosis agent has no tools (DuckDuckGo caused 429 rate-limit errors);
+# web research lives in a separate, optional agent below
+@st.cache_resource
 def make_agent():
+    # Cached so the key check and Gemini client setup run once per process,
+    # not on every Streamlit rerun
+    if not GOOGLE_API_KEY:
+        raise ValueError("⚠️ Please set your Google API Key in GOOGLE_API_KEY")
+    os.environ["GOOGLE_API_KEY"] = GOOGLE_API_KEY
+
     candidate_model_ids = [
         "gemini-pro-vision",
         "gemini-1.0-pro-vision",
@@ -35,7 +95,10 @@ def make_agent():
     last_exc = None
     for mid in candidate_model_ids:
         try:
-            agent = Agent(model=Gemini(id=mid), markdown=True)
+            agent = Agent(model=Gemini(id=mid), system_message=query, markdown=True)
+            # Build the client now so concurrent runs share one instance
+            # instead of racing to create (and drop) their own
+            agent.model.get_client()
             st.sidebar.success(f"Using model: {mid}")
             return agent
         except Exception as e:
@@ -54,113 +117,416 @@ except Exception as init_err:
     medical_agent = None
 
 
+@st.cache_resource
+def make_research_agent(model_id):
+    # Tool-using agent kept apart from the diagnosis agent, so web search
+    # never sits on the critical path of the report
+    return Agent(model=Gemini(id=model_id), tools=[DuckDuckGoTools()], markdown=True)
+
+
 # -------------------------------------------------------------------
-# Medical Analysis Prompt
+# Response Cache (exact hash -> perceptual hash -> Gemini)
 # -------------------------------------------------------------------
-query = """
-You are a highly skilled medical imaging expert with extensive knowledge in radiology and diagnostic imaging. Analyze the medical image and structure your response as follows:
+CACHE_DB_PATH = "analysis_cache.sqlite3"
+CACHE_TTL_SECONDS = 24 * 60 * 60
+CACHE_MAX_ENTRIES = 1000
+CACHE_SWEEP_INTERVAL_SECONDS = 30 * 60
+PHASH_MAX_DISTANCE = 6  # max differing bits out of 64 for a near-duplicate hit
+_UINT64_MASK = (1 << 64) - 1
 
-### 1. Image Type & Region
-- Identify imaging modality (X-ray/MRI/CT/Ultrasound/etc.).
-- Specify anatomical region and positioning.
-- Evaluate image quality and technical adequacy.
 
-### 2. Key Findings
-- Highlight primary observations systematically.
-- Identify potential abnormalities with detailed descriptions.
-- Include measurements and densities where relevant.
+def _open_cache():
+    # The table is created once per process by init_cache()
+    return sqlite3.connect(CACHE_DB_PATH)
 
-### 3. Diagnostic Assessment
-- Provide primary diagnosis with confidence level.
-- List differential diagnoses ranked by likelihood.
-- Support each diagnosis with observed evidence.
-- Highlight critical/urgent findings.
 
-### 4. Patient-Friendly Explanation
-- Simplify findings in clear, non-technical language.
-- Avoid medical jargon or provide easy definitions.
-- Include relatable visual analogies.
+def _prompt_hash():
+    # Everything besides the image that shapes a report: a new prompt or
+    # model must not be served reports written for the old one
+    return hashlib.blake2b(
+        (medical_agent.model.id + query + ANALYSIS_PROMPT).encode(), digest_size=16
+    ).hexdigest()
 
-### 5. Medical Context & Next Steps
-- Suggest standard clinical next steps (e.g., referral, biopsy, follow-up imaging).
-- Provide general treatment protocols for the identified condition based on standard medical guidelines.
 
-Ensure a structured and medically accurate response using clear markdown formatting.
-"""
+def _phash_int(image):
+    # SQLite INTEGER is signed 64-bit, so fold the unsigned hash into that range
+    value = int(str(imagehash.phash(image)), 16)
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+@st.cache_resource
+def init_cache():
+    # Once per process: create the SQLite table (a failure here just means
+    # every lookup misses) and build the hot in-memory layer in front of it.
+    # TTLCache is not thread-safe, so it comes with a lock for the
+    # concurrent analysis path
+    with suppress(sqlite3.Error), closing(_open_cache()) as conn, conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, report TEXT, "
+            "phash INTEGER, prompt_hash TEXT, ts REAL, last_accessed REAL)"
+        )
+    return TTLCache(maxsize=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS), threading.Lock()
+
+
+def sweep_cache():
+    """Delete expired rows, then keep only the CACHE_MAX_ENTRIES most recently used."""
+    cutoff = time.time() - CACHE_TTL_SECONDS
+    with closing(_open_cache()) as conn, conn:
+        conn.execute("DELETE FROM cache WHERE ts < ?", (cutoff,))
+        conn.execute(
+            "DELETE FROM cache WHERE key NOT IN "
+            "(SELECT key FROM cache ORDER BY last_accessed DESC LIMIT ?)",
+            (CACHE_MAX_ENTRIES,),
+        )
+
+
+@st.cache_resource
+def start_cache_sweeper():
+    # One daemon timer chain per process, re-armed after every sweep
+    def run():
+        try:
+            with suppress(sqlite3.Error):
+                sweep_cache()
+        finally:
+            schedule()
+
+    def schedule():
+        timer = threading.Timer(CACHE_SWEEP_INTERVAL_SECONDS, run)
+        timer.daemon = True
+        timer.start()
+
+    schedule()
+    return True
+
+
+# Resolved on the script thread so analysis worker threads can use them too
+_memory_cache, _memory_cache_lock = init_cache()
+start_cache_sweeper()
+
+
+def cached_call(func):
+    """Serve repeated or near-identical images from the cache instead of re-running the agent.
+
+    The wrapper takes the resized PIL image and yields report chunks. On a
+    miss the wrapped generator is called with the encoded WebP bytes, its
+    chunks are passed through as they arrive, and the joined report is
+    stored once the stream completes. Hits yield the whole report at once.
+    The generator returns True when the report was written for a
+    near-identical (not byte-identical) earlier image, so the UI can say so.
+    Cache I/O errors (unwritable directory, locked database) count as a miss.
+    """
+    @functools.wraps(func)
+    def wrapper(resized_image):
+        # Key on the canonical upload bytes so metadata-only differences
+        # (EXIF timestamps, source format) still hit; the wrapped function
+        # receives those same bytes
+        image_bytes = encode_image(resized_image)
+        prompt_hash = _prompt_hash()
+        key = hashlib.blake2b(image_bytes + prompt_hash.encode(), digest_size=16).hexdigest()
+        now = time.time()
+        cutoff = now - CACHE_TTL_SECONDS
+
+        # Layer 0: in-process LRU/TTL cache
+        with _memory_cache_lock:
+            cached = _memory_cache.get(key)
+        if cached is not None:
+            report, near_duplicate = cached
+            yield report
+            return near_duplicate
+
+        row = None
+        phash = None
+        near_duplicate = False
+        with suppress(sqlite3.Error), closing(_open_cache()) as conn:
+            # Layer 1: exact match on canonical image bytes + prompt
+            row = conn.execute(
+                "SELECT key, report FROM cache WHERE key = ? AND ts >= ?", (key, cutoff)
+            ).fetchone()
+
+            # Layer 2: closest perceptual hash within the Hamming threshold,
+            # among reports written for the same prompt and model
+            if row is None:
+                phash = _phash_int(resized_image)
+                best_distance = PHASH_MAX_DISTANCE + 1
+                for other_key, report, other in conn.execute(
+                    "SELECT key, report, phash FROM cache WHERE prompt_hash = ? AND ts >= ?",
+                    (prompt_hash, cutoff),
+                ):
+                    distance = ((phash ^ other) & _UINT64_MASK).bit_count()
+                    if distance < best_distance:
+                        row, best_distance = (other_key, report), distance
+                near_duplicate = row is not None
+
+            if row is not None:
+                with conn:
+                    conn.execute(
+                        "UPDATE cache SET last_accessed = ? WHERE key = ?", (now, row[0])
+                    )
+
+        if row is not None:
+            report = row[1]
+            yield report
+        else:
+            # Miss: stream from the agent, then store the complete report
+            chunks = []
+            for chunk in func(image_bytes):
+                chunks.append(chunk)
+                yield chunk
+            report = "".join(chunks)
+            if phash is None:
+                phash = _phash_int(resized_image)
+            with suppress(sqlite3.Error), closing(_open_cache()) as conn, conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache "
+                    "(key, report, phash, prompt_hash, ts, last_accessed) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, report, phash, prompt_hash, now, now),
+                )
+
+        with _memory_cache_lock:
+            _memory_cache[key] = (report, near_duplicate)
+        return near_duplicate
+
+    return wrapper
+
 
 # -------------------------------------------------------------------
 # Analyze Image Function
 # -------------------------------------------------------------------
-def analyze_medical_image(image_path):
-    temp_path = "temp_resized_image.png"
+def encode_image(resized_image):
+    # Encode in memory (no temp file). The output carries no EXIF/metadata,
+    # so it doubles as the canonical form for the cache key
+    buf = io.BytesIO()
+    # WebP q=82 is about half the size of JPEG q=85 at this resolution
+    resized_image.save(buf, format="WEBP", quality=82, method=4)
+    return buf.getvalue()
+
+
+@cached_call
+def run_agent(image_bytes):
+    # Hand the encoded bytes straight to Agno
+    agno_image = AgnoImage(content=image_bytes, format="webp")
+
+    # Stream so the UI can render the report while it is being generated
+    for event in medical_agent.run(ANALYSIS_PROMPT, images=[agno_image], stream=True):
+        if event.event == RunEvent.run_error:
+            # Agno reports API failures as an event; raise so they are never cached
+            raise RuntimeError(event.content)
+        if event.event == RunEvent.run_content and event.content:
+            yield event.content
+
+
+MAX_IMAGE_SIDE = 500  # longest side sent to Gemini
+
+
+def load_image(source):
+    image = PILImage.open(source)
+    # JPEGs decode straight to a DCT-scaled size (1/2, 1/4, 1/8) that still
+    # covers the target, skipping most of the full-resolution decode
+    image.draft("RGB", (MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+    return image
+
+
+def downscale(image, max_side):
+    """Fit image within max_side x max_side, keeping the aspect ratio; never upscales."""
+    scale = max_side / max(image.size)
+    if scale >= 1:
+        return image
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    if image.mode.startswith("I;16"):
+        # reduce() has no I;16 kernel; 32-bit I holds the same values
+        image = image.convert("I")
+    # reducing_gap box-reduces by an integer factor before the filter runs
+    # (area averaging, like cv2.INTER_AREA) and, unlike copy() + thumbnail(),
+    # never duplicates the full-size image. BILINEAR is several times faster
+    # than LANCZOS (and the fastest Pillow-SIMD kernel) with no visible loss here
+    return image.resize(size, PILImage.Resampling.BILINEAR, reducing_gap=2.0)
+
+
+def to_8bit(image):
+    """Stretch 16/32-bit integer images (e.g. I;16 DICOM exports) to 8-bit grayscale.
+
+    convert("RGB") clips these at 255 instead of scaling, which turns a
+    12-bit scan almost entirely white. Apply before downscale(): resize()
+    cannot box-reduce I;16 images.
+    """
+    if not image.mode.startswith("I"):
+        return image
+    low, high = image.getextrema()
+    scale = 255 / (high - low) if high > low else 0
+    return image.point(lambda v: (v - low) * scale).convert("L")
+
+
+def analyze_medical_image(image):
     try:
-        image = PILImage.open(image_path)
-        
         # Resize logic to save tokens and speed up upload
-        aspect_ratio = image.width / image.height
-        new_width = 500
-        new_height = int(new_width / aspect_ratio)
-        resized_image = image.resize((new_width, new_height))
-        
-        resized_image.save(temp_path)
-        
-        # Pass the image to the agent
-        agno_image = AgnoImage(filepath=temp_path)
-        response = medical_agent.run(query, images=[agno_image])
-        return response.content
-        
+        resized_image = downscale(to_8bit(image), MAX_IMAGE_SIDE)
+        # Normalize the mode up front so every upload encodes the same way;
+        # convert() copies even when the mode already matches, so skip it then
+        if resized_image.mode != "RGB":
+            resized_image = resized_image.convert("RGB")
+
+        # Pass on cached_call's near-duplicate flag
+        return (yield from run_agent(resized_image))
+
     except Exception as e:
-        return f"⚠️ Analysis error: {e}"
-        
-    finally:
-        # Cleanup temp file
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+        yield f"⚠️ Analysis error: {e}"
+
+
+def analyze_to_text(image):
+    # Non-streaming form for callers that need the whole report at once;
+    # returns (report, near_duplicate)
+    chunks = []
+    stream = analyze_medical_image(image)
+    while True:
+        try:
+            chunks.append(next(stream))
+        except StopIteration as done:
+            return "".join(chunks), bool(done.value)
+
+
+# -------------------------------------------------------------------
+# Concurrent Analysis (batch / test images)
+# -------------------------------------------------------------------
+N_INFLIGHT = 4  # max Gemini calls in flight at once
+
+
+async def analyze_async(image, semaphore):
+    async with semaphore:
+        return await asyncio.to_thread(analyze_to_text, image)
+
+
+async def analyze_many(images):
+    # Overlap the network round trips: wall time ~1x latency instead of Nx
+    semaphore = asyncio.Semaphore(N_INFLIGHT)
+    return await asyncio.gather(*(analyze_async(image, semaphore) for image in images))
+
+# -------------------------------------------------------------------
+# Bundled Test Images
+# -------------------------------------------------------------------
+TEST_IMAGES = [
+    ("Test Case 1", "test_images/test1.png"),
+    ("Test Case 2", "test_images/test2.png"),
+]
+
+
+def load_test_image(path):
+    # Open and fully decode, so batch loads can run side by side in worker
+    # threads (Pillow releases the GIL while decoding)
+    with suppress(FileNotFoundError):
+        image = load_image(path)
+        image.load()
+        return image
+    return None
+
+
+def _prewarm_one(path):
+    image = load_test_image(path)
+    if image is not None:
+        analyze_to_text(image)
+
+
+@st.cache_resource
+def prewarm_test_images():
+    # Once per server process: analyze the bundled images in the background
+    # so the first click is a cache hit and the Gemini connection is warm
+    executor = ThreadPoolExecutor(max_workers=len(TEST_IMAGES))
+    for _, path in TEST_IMAGES:
+        executor.submit(_prewarm_one, path)
+    executor.shutdown(wait=False)
+    return True
+
+
+if medical_agent is not None:
+    prewarm_test_images()
 
 # -------------------------------------------------------------------
 # Summary Extractor
 # -------------------------------------------------------------------
+_SUMMARY_JSON_RE = re.compile(r"```json\s*(\{.*?\})\s*```", re.DOTALL)
+_SUMMARY_LABEL = "primary diagnosis"
+SUMMARY_FALLBACK = "See detailed report below."
+
+
+@functools.lru_cache(maxsize=128)
+def extract_diagnosis(report):
+    """Return (primary diagnosis, confidence) from a report.
+
+    confidence is a 0-1 float or None; diagnosis is None when not found.
+    """
+    # Memoized: the same report feeds the UI summary and the references search.
+    # Preferred: the JSON block the prompt asks the model to append
+    match = _SUMMARY_JSON_RE.search(report)
+    if match:
+        try:
+            data = json.loads(match.group(1))
+        except json.JSONDecodeError:
+            data = {}
+        diagnosis = data.get("primary_diagnosis")
+        if diagnosis:
+            confidence = data.get("confidence")
+            # bool is an int subclass; reject true/false as a confidence
+            if isinstance(confidence, bool) or not (
+                isinstance(confidence, (int, float)) and 0 <= confidence <= 1
+            ):
+                confidence = None
+            return str(diagnosis).strip(), confidence
+
+    # Fallback for reports without a usable JSON block: search only the
+    # Diagnostic Assessment section, located with two find() calls. Only a
+    # same-level "### " header ends it; "####" subheaders stay inside
+    section = report
+    start = report.find("### 3. Diagnostic Assessment")
+    if start >= 0:
+        end = report.find("\n### ", start + 4)
+        section = report[start:end] if end >= 0 else report[start:]
+
+    # Take the rest of the first "Primary Diagnosis:" line with plain find()
+    # and slicing; markdown bold around the label or value is stripped
+    lowered = section.lower()
+    start = lowered.find(_SUMMARY_LABEL)
+    while start >= 0:
+        end = section.find("\n", start)
+        line = section[start:end] if end >= 0 else section[start:]
+        label, colon, value = line.partition(":")
+        value = value.strip().strip(" *")
+        if colon and not label[len(_SUMMARY_LABEL):].strip(" *") and value:
+            return value, None
+        start = lowered.find(_SUMMARY_LABEL, start + len(_SUMMARY_LABEL))
+    return None, None
+
+
 def extract_summary(report):
-    try:
-        # Attempt to grab the text after the Diagnostic Assessment header
-        if "### 3. Diagnostic Assessment" in report:
-            diagnostic_section = report.split("### 3. Diagnostic Assessment")[1]
-        else:
-            diagnostic_section = report
+    # Display form for the summary box: diagnosis plus confidence if known
+    diagnosis, confidence = extract_diagnosis(report)
+    if diagnosis is None:
+        return SUMMARY_FALLBACK
+    if confidence is not None:
+        return f"{diagnosis} (confidence: {confidence:.0%})"
+    return diagnosis
 
-        # Look for "Primary Diagnosis:" pattern
-        match = re.search(r"Primary Diagnosis\s*:\s*(.*)", diagnostic_section, re.IGNORECASE)
-        if match:
-            # Return just the first line of the diagnosis
-            return match.group(1).split('\n')[0].strip()
-            
-    except Exception:
-        pass
 
-    return "See detailed report below."
+def strip_summary_block(report):
+    # The JSON block is for the app, not the reader
+    return _SUMMARY_JSON_RE.sub("", report).rstrip()
 
 # -------------------------------------------------------------------
 # UI Setup
 # -------------------------------------------------------------------
 st.set_page_config(page_title="Medical Image Analysis", layout="centered")
 
-st.markdown("""
-    <style>
-        html, body, [class*="css"] {
-            font-family: 'Segoe UI', sans-serif;
-            background-color: #f9fbfc;
-        }
-        .main {
-            padding: 2rem;
-            background-color: #ffffff;
-            border-radius: 12px;
-            box-shadow: 0px 4px 12px rgba(0,0,0,0.05);
-        }
-        h1 { color: #045d75; }
-        .stMarkdown { font-size: 1rem; line-height: 1.6; }
-        div[data-testid="stImage"] img { border-radius: 8px; }
-    </style>
-""", unsafe_allow_html=True)
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets")
+
+
+@st.cache_data
+def read_asset(name):
+    # Static CSS/HTML lives in assets/ next to this script (Streamlit keeps the
+    # caller's working directory); read from disk once, not on every rerun
+    with open(os.path.join(ASSETS_DIR, name), encoding="utf-8") as f:
+        return f.read()
+
+
+st.markdown(f"<style>{read_asset('style.css')}</style>", unsafe_allow_html=True)
 
 # -------------------------------------------------------------------
 # Title & Sidebar
@@ -170,56 +536,138 @@ st.markdown("Upload a medical image for a structured AI diagnostic report.")
 
 st.sidebar.header("📤 Upload Medical Image")
 uploaded_file = st.sidebar.file_uploader("", type=["jpg", "jpeg", "png", "bmp", "gif"])
+# Off by default: DuckDuckGo rate-limits (429) under load
+fetch_references = st.sidebar.checkbox("📚 Fetch research references (web search)", value=False)
 
 # -------------------------------------------------------------------
 # Logic
 # -------------------------------------------------------------------
-def handle_image(image_path, caption="Uploaded Image"):
-    with st.spinner("🔍 Running analysis..."):
-        report = analyze_medical_image(image_path)
-        summary = extract_summary(report)
+PREVIEW_SIDE = 300  # the image column is ~1/3 of the centered layout
+
 
-        col1, col2 = st.columns([1, 2])
-        with col1:
+def render_report(image, report_stream, caption):
+    # Derive the preview from the already-decoded image instead of handing
+    # Streamlit the full-size original to re-encode
+    try:
+        preview = downscale(to_8bit(image), PREVIEW_SIDE)
+    except Exception as e:
+        preview, preview_error = None, e
+
+    col1, col2 = st.columns([1, 2])
+    with col1:
+        if preview is None:
+            st.warning(f"⚠️ Preview error: {preview_error}")
+        else:
             # Fixed warning by using width="stretch"
-            st.image(image_path, caption=f"🖼️ {caption}", width="stretch")
+            st.image(preview, caption=f"🖼️ {caption}", width="stretch")
+
+    with col2:
+        st.subheader("📋 Report")
+        summary_slot = st.empty()
+        note_slot = st.empty()
+        report_slot = st.empty()
 
-        with col2:
-            st.subheader("📋 Report")
-            if "⚠️" not in report:
-                st.info(f"**Diagnostic Summary:** {summary}")
-            st.markdown(report, unsafe_allow_html=True)
+        near_duplicate = False
+
+        def tracked():
+            # Capture the stream's near-duplicate flag while Streamlit consumes it
+            nonlocal near_duplicate
+            near_duplicate = yield from report_stream
+
+        with report_slot:
+            report = st.write_stream(tracked())
+        # Swap the raw stream for the cleaned report, then fill in the summary
+        report_slot.markdown(strip_summary_block(report), unsafe_allow_html=True)
+        if "⚠️" not in report:
+            summary_slot.info(f"**Diagnostic Summary:** {extract_summary(report)}")
+        if near_duplicate:
+            note_slot.caption(
+                "ℹ️ Cached report for a near-identical earlier image, not a fresh "
+                "analysis of this one. Small differences may not be reflected."
+            )
+
+    return report
+
+
+def render_references(diagnosis):
+    with st.spinner("📚 Fetching references..."):
+        try:
+            research_agent = make_research_agent(medical_agent.model.id)
+            response = research_agent.run(RESEARCH_PROMPT.format(diagnosis=diagnosis))
+            if response.status == RunStatus.error:
+                raise RuntimeError(response.content)
+        except Exception as e:
+            st.warning(f"⚠️ Could not fetch references: {e}")
+            return
+    st.subheader("📚 References")
+    st.markdown(response.content, unsafe_allow_html=True)
+
+
+def handle_image(image, caption="Uploaded Image"):
+    # No spinner: the streamed report is its own progress indicator
+    report = render_report(image, analyze_medical_image(image), caption)
+
+    # Progressive disclosure: the report is already on screen while search runs
+    if fetch_references and "⚠️" not in report:
+        # The bare diagnosis, without the display-only confidence suffix
+        diagnosis, _ = extract_diagnosis(report)
+        if diagnosis is not None:
+            render_references(diagnosis)
+
+
+def replay(report, near_duplicate):
+    # A finished analysis in the same stream form analyze_medical_image() returns
+    yield report
+    return near_duplicate
+
+
+def handle_images(images):
+    # images: list of (PIL image, caption); all reports are fetched concurrently
+    with st.spinner(f"🔍 Running {len(images)} analyses..."):
+        results = asyncio.run(analyze_many([image for image, _ in images]))
+        for (image, caption), (report, near_duplicate) in zip(images, results):
+            render_report(image, replay(report, near_duplicate), caption)
 
 # Handle Upload
 if uploaded_file is not None:
-    file_extension = uploaded_file.type.split('/')[-1]
-    image_path = f"temp_image.{file_extension}"
-    
-    with open(image_path, "wb") as f:
-        f.write(uploaded_file.getbuffer())
-        
-    handle_image(image_path)
-    
-    if os.path.exists(image_path):
-        os.remove(image_path)
+    # UploadedFile is already an in-memory BytesIO, so PIL can read it directly
+    # open() is lazy, so decode here too: truncated files raise now, not mid-render.
+    # OSError also covers UnidentifiedImageError
+    try:
+        uploaded_image = load_image(uploaded_file)
+        uploaded_image.load()
+    except OSError as e:
+        st.error(f"⚠️ Could not read image: {e}")
+    else:
+        handle_image(uploaded_image)
 else:
     st.info("Please upload an image to begin.")
 
 # Test Images (Optional)
 st.sidebar.markdown("---")
 st.sidebar.subheader("🧪 Test Data")
-if st.sidebar.button("Load Test Image 1"):
-    if os.path.exists("test_images/test1.png"):
-        handle_image("test_images/test1.png", caption="Test Case 1")
+# Open directly and handle FileNotFoundError: one syscall, no exists()/open() race
+for i, (caption, path) in enumerate(TEST_IMAGES, start=1):
+    if st.sidebar.button(f"Load Test Image {i}"):
+        try:
+            test_image = load_image(path)
+        except FileNotFoundError:
+            st.sidebar.error(f"{path} not found.")
+        else:
+            handle_image(test_image, caption=caption)
+
+if st.sidebar.button("Run All Test Images"):
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        loaded = list(executor.map(load_test_image, [path for _, path in TEST_IMAGES]))
+    test_images = [
+        (image, caption) for image, (caption, _) in zip(loaded, TEST_IMAGES) if image is not None
+    ]
+    if test_images:
+        handle_images(test_images)
     else:
-        st.sidebar.error("test_images/test1.png not found.")
+        st.sidebar.error("No test images found in test_images/.")
 
 # -------------------------------------------------------------------
 # Footer
 # -------------------------------------------------------------------
-st.markdown("""
-<hr style="margin-top: 2rem;">
-<div style='text-align: center; color: #555;'>
-    Made with ❤️ by <a href="https://www.linkedin.com/in/vijay-kapse/" target="_blank">Vijay Suryakant Kapse</a>
-</div>
-""", unsafe_allow_html=True)
+st.markdown(read_asset("footer.html"), unsafe_allow_html=True)